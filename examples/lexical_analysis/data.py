@@ -15,7 +15,12 @@
 The file_reader converts raw corpus to input.
 """
 
+import glob
 import os
+import shutil
+import sys
+import math
+import hashlib
 
 import paddle
 import numpy as np
@@ -25,9 +30,16 @@ import numpy as np
 #              p-B\002p-I\002r-B\002v-B\002v-I\002m-B\002m-I\002m-I\002ORG-B\002ORG-I\002n-B\002n-I\002
 CHAR_DELIMITER = "\002"
 
+# The version of the conversion to ids and of the cache format, it is hashed
+# into the cache key. Bump it whenever either of them changes, so that the
+# caches built by the older code are not loaded.
+CACHE_VERSION = 2
+
 
 class LacDataset(paddle.io.Dataset):
-    """Load the dataset and convert all the texts to ids.
+    """Load the dataset and convert all the texts to ids. The converted ids are cached in the `cache` folder of
+        the dataset directory, keyed by a hash of the dataset and dictionary files, so the cache is rebuilt when
+        any of them is modified.
 
         Args:
             base_path (str): the path of the dataset directory.
@@ -54,7 +66,15 @@ class LacDataset(paddle.io.Dataset):
         if self.mode in {"train", "test", "infer"}:
             self.dataset_path = os.path.join(self.base_path,
                                              "%s.tsv" % self.mode)
-            self._read_file()
+            cache_key = self._get_cache_key([
+                self.dataset_path, word_dict_path, label_dict_path,
+                word_rep_dict_path
+            ])
+            self.cache_path = os.path.join(self.base_path, "cache",
+                                           "%s_%s" % (self.mode, cache_key))
+            if not self._load_cache():
+                self._read_file()
+                self._save_cache()
         else:
             raise ValueError(
                 'Invalid mode: %s. Only support "train", "test" and "infer"' %
@@ -64,18 +84,23 @@ class LacDataset(paddle.io.Dataset):
         return self.total
 
     def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        word_ids = np.array(self.words[start:end], dtype=np.int32)
         if self.mode == "infer":
-            return [self.word_ids[index], len(self.word_ids[index])]
+            return [word_ids, len(word_ids)]
         else:
             return [
-                self.word_ids[index], len(self.word_ids[index]),
-                self.label_ids[index]
+                word_ids, len(word_ids),
+                np.array(self.labels[start:end], dtype=np.int32)
             ]
 
     def _read_file(self):
-        self.word_ids = []
-        self.label_ids = []
-        self.total = 0
+        word_ids = []
+        label_ids = []
+        word_table = self._build_char_table(
+            self.word_vocab,
+            oov_replace="OOV",
+            token_replace=self.word_replace_dict)
         with open(self.dataset_path, "r", encoding="utf-8") as fread:
             if self.mode != "infer":
                 next(fread)
@@ -87,25 +112,118 @@ class LacDataset(paddle.io.Dataset):
                     words, labels = line.split("\t")
                     words = words.split(CHAR_DELIMITER)
 
-                tmp_word_ids = self._convert_tokens_to_ids(
-                    words,
-                    self.word_vocab,
-                    oov_replace="OOV",
-                    token_replace=self.word_replace_dict)
+                if word_table is not None and all(
+                        len(word) == 1 for word in words):
+                    # All the words are single characters, look them up
+                    # by their code points at once.
+                    text = "".join(words)
+                    tmp_word_ids = word_table[np.frombuffer(
+                        text.encode("utf-32-le"), dtype=np.uint32)]
+                else:
+                    tmp_word_ids = self._convert_tokens_to_ids(
+                        words,
+                        self.word_vocab,
+                        oov_replace="OOV",
+                        token_replace=self.word_replace_dict)
 
-                self.word_ids.append(tmp_word_ids)
+                word_ids.append(tmp_word_ids)
                 if self.mode != "infer":
-                    tmp_label_ids = self._convert_tokens_to_ids(
-                        labels.split(CHAR_DELIMITER),
-                        self.label_vocab,
-                        oov_replace="O")
-                    self.label_ids.append(tmp_label_ids)
+                    tmp_label_ids = np.array(
+                        self._convert_tokens_to_ids(
+                            labels.split(CHAR_DELIMITER),
+                            self.label_vocab,
+                            oov_replace="O"),
+                        dtype=np.int64)
+                    label_ids.append(tmp_label_ids)
                     assert len(tmp_word_ids) == len(
                         tmp_label_ids
                     ), "The word ids %s is not match with the label ids %s" % (
                         tmp_word_ids, tmp_label_ids)
 
-                self.total += 1
+        # Store all the sentences in one flat array and keep the offsets of
+        # every sentence. The ids are stored in 16 bits when the vocabulary
+        # fits, which quarters the size of the arrays in memory and on disk.
+        self.lengths = np.array([len(ids) for ids in word_ids], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        empty = np.zeros([0], dtype=np.int64)
+        self.words = np.concatenate([empty] + word_ids).astype(
+            self._get_id_dtype(self.vocab_size))
+        self.labels = np.concatenate([empty] + label_ids).astype(
+            self._get_id_dtype(self.num_labels))
+        self.total = len(self.lengths)
+
+    def _get_id_dtype(self, size):
+        return np.uint16 if size <= np.iinfo(np.uint16).max + 1 else np.int32
+
+    def _get_cache_key(self, paths):
+        """
+        Hash the cache version and the modification time and size of the
+        dataset and vocab files, so a modified file or conversion leads to a
+        new cache folder.
+        """
+        key = "-".join(["v%d" % CACHE_VERSION] + [
+            "%s:%f:%d" % (os.path.basename(path), os.path.getmtime(path),
+                          os.path.getsize(path)) for path in paths
+        ])
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+    def _load_cache(self):
+        """
+        Load the converted ids from the memory-mapped cache files if they exist.
+        """
+        # The offsets are saved last, so the cache is complete once they exist.
+        offsets_path = os.path.join(self.cache_path, "offsets.npy")
+        if not os.path.exists(offsets_path):
+            return False
+        self.words = np.load(
+            os.path.join(self.cache_path, "words.npy"), mmap_mode="r")
+        self.labels = np.load(
+            os.path.join(self.cache_path, "labels.npy"), mmap_mode="r")
+        self.offsets = np.load(offsets_path)
+        self.lengths = np.diff(self.offsets)
+        self.total = len(self.lengths)
+        return True
+
+    def _save_cache(self):
+        """
+        Save the converted ids, every file is written to a temporary file
+        first and then renamed, since several ranks may build the cache at
+        the same time.
+        """
+        try:
+            os.makedirs(self.cache_path, exist_ok=True)
+            for name in ["words", "labels", "offsets"]:
+                path = os.path.join(self.cache_path, "%s.npy" % name)
+                tmp_path = "%s.%d.tmp" % (path, os.getpid())
+                with open(tmp_path, "wb") as fout:
+                    np.save(fout, getattr(self, name))
+                os.replace(tmp_path, path)
+        except OSError:
+            # The dataset directory may be read-only, just skip the cache.
+            return
+        # Remove the caches of the outdated versions of the same file.
+        cache_dir, cache_name = os.path.split(self.cache_path)
+        for path in glob.glob(os.path.join(cache_dir, "%s_*" % self.mode)):
+            if os.path.basename(path) != cache_name:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _build_char_table(self, vocab, oov_replace=None, token_replace=None):
+        """
+        Build a table that maps every unicode code point to the id of the
+        single-character token, the replacement is applied in advance.
+        """
+        if vocab.get(oov_replace) is None:
+            return None
+        table = np.full(
+            sys.maxunicode + 1, int(vocab[oov_replace]), dtype=np.int64)
+        token_replace = token_replace or {}
+        for token in set(vocab) | set(token_replace):
+            if len(token) != 1:
+                continue
+            token_id = vocab.get(token_replace.get(token, token))
+            if token_id is not None:
+                table[ord(token)] = int(token_id)
+        return table
 
     def _load_vocab(self, dict_path):
         """
@@ -148,6 +266,150 @@ class LacDataset(paddle.io.Dataset):
         return token_ids
 
 
+class ReusableBatchify(object):
+    """Pad the samples of a mini-batch by writing them row by row into int32 staging buffers, which skips the
+        per-sample `np.asarray` conversion and padding of `Tuple(Pad, Stack, Pad)`. The buffers are kept across
+        batches and grow when a longer sequence or a larger batch comes.
+
+        Every call still returns new arrays: contiguous copies of the filled part of the buffers, so they stay
+        valid however the dataloader passes them on, e.g. when a worker pickles them in a background thread
+        while the next batch is being filled.
+
+        Args:
+            batch_size (int): The initial number of sequences the buffers can hold.
+            max_seq_len (int): The initial sequence length the buffers can hold.
+            pad_val (int, optional): The value used to pad the word ids and label ids. Defaults to 0.
+            fixed_seq_len (bool, optional): If True, every batch is padded to `max_seq_len` and the longer
+                sequences are truncated, so that all the batches have the same sequence length. Defaults to False.
+        """
+
+    def __init__(self, batch_size, max_seq_len, pad_val=0, fixed_seq_len=False):
+        self.pad_val = pad_val
+        self.max_seq_len = max_seq_len
+        self.fixed_seq_len = fixed_seq_len
+        self._allocate(batch_size, max_seq_len)
+
+    def _allocate(self, batch_size, max_seq_len):
+        self.word_buf = np.full(
+            (batch_size, max_seq_len), self.pad_val, dtype=np.int32)
+        self.label_buf = np.full(
+            (batch_size, max_seq_len), self.pad_val, dtype=np.int32)
+        self.length_buf = np.zeros((batch_size, ), dtype=np.int64)
+
+    def __call__(self, samples):
+        batch_size = len(samples)
+        if self.fixed_seq_len:
+            max_len = self.max_seq_len
+        else:
+            max_len = max(sample[1] for sample in samples)
+        if batch_size > self.word_buf.shape[0] or max_len > self.word_buf.shape[
+                1]:
+            self._allocate(
+                max(batch_size, self.word_buf.shape[0]),
+                max(max_len, self.word_buf.shape[1]))
+
+        with_labels = len(samples[0]) > 2
+        word_ids = self.word_buf[:batch_size, :max_len]
+        label_ids = self.label_buf[:batch_size, :max_len]
+        lengths = self.length_buf[:batch_size]
+        for i, sample in enumerate(samples):
+            length = min(sample[1], max_len)
+            lengths[i] = length
+            word_ids[i, :length] = sample[0][:length]
+            word_ids[i, length:] = self.pad_val
+            if with_labels:
+                label_ids[i, :length] = sample[2][:length]
+                label_ids[i, length:] = self.pad_val
+        if with_labels:
+            return word_ids.copy(), lengths.copy(), label_ids.copy()
+        return word_ids.copy(), lengths.copy()
+
+
+class BucketingBatchSampler(paddle.io.BatchSampler):
+    """Group the examples with similar lengths into the same mini-batch, so that less padding is needed.
+
+        The examples are split into `num_buckets` buckets by the quantiles of their lengths. Every epoch, the
+        examples are shuffled inside each bucket and the resulting batches are shuffled again, using a random
+        seed shared by all the ranks, so that every rank draws the same batch list and takes its own shard.
+
+        Args:
+            lengths (list): The length of every example in the dataset.
+            batch_size (int): The number of examples contained in a mini-batch.
+            num_buckets (int, optional): The number of length buckets. Defaults to 32.
+            num_replicas (int, optional): The number of training processes. Defaults to the world size.
+            rank (int, optional): The rank of the current process. Defaults to the current rank.
+            shuffle (bool, optional): Whether to shuffle the examples and the batches. Defaults to True.
+            drop_last (bool, optional): Whether to drop the last incomplete batch. Defaults to False.
+        """
+
+    def __init__(self,
+                 lengths,
+                 batch_size,
+                 num_buckets=32,
+                 num_replicas=None,
+                 rank=None,
+                 shuffle=True,
+                 drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas if num_replicas is not None else paddle.distributed.get_world_size(
+        )
+        self.local_rank = rank if rank is not None else paddle.distributed.get_rank(
+        )
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        boundaries = np.quantile(self.lengths,
+                                 np.linspace(0, 1, num_buckets + 1))
+        bucket_ids = np.digitize(self.lengths, boundaries[1:-1])
+        self.buckets = [
+            np.where(bucket_ids == i)[0] for i in range(num_buckets)
+        ]
+        self.buckets = [bucket for bucket in self.buckets if len(bucket) > 0]
+
+        num_samples = len(self.lengths)
+        self.num_batches = num_samples // self.batch_size if self.drop_last \
+            else int(math.ceil(num_samples / self.batch_size))
+
+    def __iter__(self):
+        # All the ranks share the same seed, so they build the same batches.
+        rng = np.random.RandomState(self.epoch)
+        # Buckets are laid out in length order, so only the batches crossing
+        # a bucket boundary mix two neighbouring buckets.
+        indices = np.concatenate([
+            rng.permutation(bucket) if self.shuffle else bucket
+            for bucket in self.buckets
+        ])
+        batches = [
+            indices[start:start + self.batch_size].tolist()
+            for start in range(0, len(indices), self.batch_size)
+        ]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        # Make sure every rank gets the same number of batches.
+        if self.drop_last:
+            batches = batches[:len(self) * self.num_replicas]
+        else:
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+        for batch in batches[self.local_rank::self.num_replicas]:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_batches // self.num_replicas
+        return int(math.ceil(self.num_batches / self.num_replicas))
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch number, which is used as the random seed of the shuffling.
+        """
+        self.epoch = epoch
+
+
 def parse_lac_result(words, preds, lengths, word_vocab, label_vocab):
     """ parse padding result """
     batch_out = []
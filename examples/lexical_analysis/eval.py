@@ -19,12 +19,11 @@ import argparse
 
 import numpy as np
 import paddle
-from paddle.static import InputSpec
-from paddlenlp.data import Pad, Tuple, Stack
 from paddlenlp.metrics import ChunkEvaluator
 
-from data import LacDataset
+from data import LacDataset, ReusableBatchify
 from model import BiGruCrf
+from train import evaluate
 
 # yapf: disable
 parser = argparse.ArgumentParser(__doc__)
@@ -39,17 +38,11 @@ args = parser.parse_args()
 # yapf: enable
 
 
-def evaluate(args):
-    place = paddle.CUDAPlace(0) if args.use_gpu else paddle.CPUPlace()
+def do_eval(args):
     paddle.set_device("gpu" if args.use_gpu else "cpu")
 
     # create dataset.
     test_dataset = LacDataset(args.data_dir, mode='test')
-    batchify_fn = lambda samples, fn=Tuple(
-        Pad(axis=0, pad_val=0),  # word_ids
-        Stack(),  # length
-        Pad(axis=0, pad_val=0),  # label_ids
-    ): fn(samples)
 
     # Create sampler for dataloader
     test_sampler = paddle.io.BatchSampler(
@@ -60,29 +53,20 @@ def evaluate(args):
     test_loader = paddle.io.DataLoader(
         dataset=test_dataset,
         batch_sampler=test_sampler,
-        places=place,
         return_list=True,
-        collate_fn=batchify_fn)
+        collate_fn=ReusableBatchify(args.batch_size, args.max_seq_len))
 
     # Define the model network and metric evaluator
     network = BiGruCrf(args.emb_dim, args.hidden_size, test_dataset.vocab_size,
                        test_dataset.num_labels)
-    inputs = InputSpec(shape=(-1, ), dtype="int16", name='inputs')
-    lengths = InputSpec(shape=(-1, ), dtype="int16", name='lengths')
-    model = paddle.Model(network, inputs=[inputs, lengths])
-    chunk_evaluator = ChunkEvaluator(
-        label_list=test_dataset.label_vocab.keys(), suffix=True)
-    model.prepare(None, None, chunk_evaluator)
+    label_list = list(test_dataset.label_vocab.keys())
+    chunk_evaluator = ChunkEvaluator(label_list=label_list, suffix=True)
 
-    # Load the model and start predicting
-    model.load(args.init_checkpoint)
-    model.evaluate(
-        eval_data=test_loader,
-        batch_size=args.batch_size,
-        log_freq=100,
-        verbose=2, )
+    # Load the model and start evaluating with the same loop as train.py
+    network.set_state_dict(paddle.load(args.init_checkpoint + ".pdparams"))
+    evaluate(network, chunk_evaluator, test_loader)
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    evaluate(args)
+    do_eval(args)
@@ -87,18 +87,35 @@ class BiGruCrf(nn.Layer):
         self.viterbi_decoder = ViterbiDecoder(self.crf.transitions,
                                               with_start_stop_tag)
 
-    def forward(self, inputs, lengths, labels=None):
-        word_embed = self.word_embedding(inputs)
-        bigru_output, _ = self.gru(word_embed)
+    def get_emission(self, inputs, lengths):
+        """Compute the emission scores of the crf layer. It is kept apart from the crf layers, so that it can be
+        converted by `paddle.jit.to_static` on its own.
+
+        Args:
+            inputs (Tensor): The word ids with shape `[batch_size, sequence_length]`.
+            lengths (Tensor): The real lengths of the sequences with shape `[batch_size]`.
+
+        Returns:
+            Tensor: The emission scores with shape `[batch_size, sequence_length, num_tags]`.
+        """
+        # The ids are fed as int32 to halve the data moved from the dataloader,
+        # and cast to int64 on the device.
+        word_embed = self.word_embedding(paddle.cast(inputs, 'int64'))
+        # Passing the real lengths lets the GRU stop at the end of every
+        # sequence instead of running over the padding, and makes the
+        # backward direction start from the last real word.
+        bigru_output, _ = self.gru(word_embed, sequence_length=lengths)
         emission = self.fc(bigru_output)
-        _, prediction = self.viterbi_decoder(emission, lengths)
+        return emission
+
+    def forward(self, inputs, lengths, labels=None):
+        emission = self.get_emission(inputs, lengths)
         if labels is not None:
-            loss = self.crf_loss(emission, lengths, prediction, labels)
-            return loss, lengths, prediction, labels
+            # The crf loss does not use the predictions, so skip the viterbi
+            # decoding, which syncs with the device to trace back the paths.
+            labels = paddle.cast(labels, 'int64')
+            loss = self.crf_loss(emission, lengths, None, labels)
+            return loss
         else:
+            _, prediction = self.viterbi_decoder(emission, lengths)
             return inputs, lengths, prediction
-
-
-def get_loss(loss, lengths, prediction, labels):
-    # get loss from the output from the BiGruCrf forward
-    return loss
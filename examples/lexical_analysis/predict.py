@@ -46,7 +46,7 @@ def infer(args):
     infer_dataset = LacDataset(args.data_dir, mode='infer')
 
     batchify_fn = lambda samples, fn=Tuple(
-        Pad(axis=0, pad_val=0),  # word_ids
+        Pad(axis=0, pad_val=0, dtype='int32'),  # word_ids
         Stack(),  # length
     ): fn(samples)
 
@@ -66,8 +66,8 @@ def infer(args):
     # Define the model network
     network = BiGruCrf(args.emb_dim, args.hidden_size, infer_dataset.vocab_size,
                        infer_dataset.num_labels)
-    inputs = InputSpec(shape=(-1, ), dtype="int16", name='inputs')
-    lengths = InputSpec(shape=(-1, ), dtype="int16", name='lengths')
+    inputs = InputSpec(shape=(-1, ), dtype="int32", name='inputs')
+    lengths = InputSpec(shape=(-1, ), dtype="int64", name='lengths')
     model = paddle.Model(network, inputs=[inputs, lengths])
     model.prepare()
 
@@ -81,7 +81,10 @@ def infer(args):
     preds = np.array(
         [pred for batch_pred in crf_decodes for pred in batch_pred])
 
-    results = parse_lac_result(infer_dataset.word_ids, preds, lengths,
+    word_ids = [
+        infer_dataset[index][0] for index in range(len(infer_dataset))
+    ]
+    results = parse_lac_result(word_ids, preds, lengths,
                                infer_dataset.word_vocab,
                                infer_dataset.label_vocab)
 
@@ -13,20 +13,20 @@
 # limitations under the License.
 
 import os
-import ast
 import math
+import time
 import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import paddle
 from paddle.static import InputSpec
-from paddlenlp.data import Pad, Tuple, Stack
-from paddlenlp.layers.crf import LinearChainCrfLoss, ViterbiDecoder
 from paddlenlp.metrics import ChunkEvaluator
 import distutils.util
 
-from data import LacDataset
-from model import BiGruCrf, get_loss
+from data import LacDataset, BucketingBatchSampler, ReusableBatchify
+from model import BiGruCrf
 
 # yapf: disable
 parser = argparse.ArgumentParser(__doc__)
@@ -36,39 +36,131 @@ parser.add_argument("--model_save_dir", type=str, default=None, help="The model
 parser.add_argument("--epochs", type=int, default=10, help="Corpus iteration num.")
 parser.add_argument("--batch_size", type=int, default=300, help="The number of sequences contained in a mini-batch.")
 parser.add_argument("--max_seq_len", type=int, default=64, help="Number of words of the longest seqence.")
+parser.add_argument("--grad_accum_steps", type=int, default=1, help="Number of micro-batches to accumulate the gradients of before updating the parameters.")
 parser.add_argument("--n_gpu", type=int, default=1, help="Number of GPUs to use, 0 for CPU.")
 parser.add_argument("--base_lr", type=float, default=0.001, help="The basic learning rate that affects the entire network.")
 parser.add_argument("--emb_dim", type=int, default=128, help="The dimension in which a word is embedded.")
 parser.add_argument("--hidden_size", type=int, default=128, help="The number of hidden nodes in the GRU layer.")
-parser.add_argument("--verbose", type=ast.literal_eval, default=128, help="Print reader and training time in details.")
+parser.add_argument("--num_workers", type=int, default=4, help="The number of subprocesses used to load and batchify the data, 0 for the main process.")
+parser.add_argument("--logging_steps", type=int, default=10, help="Log every X updates steps.")
+parser.add_argument("--save_steps", type=int, default=100, help="Save checkpoint every X updates steps.")
+parser.add_argument("--eval_steps", type=int, default=100, help="Evaluate the model every X updates steps.")
+parser.add_argument("--use_bucketing", type=distutils.util.strtobool, default=True, help="To batch the sequences with similar lengths together if True.")
+parser.add_argument("--to_static", type=distutils.util.strtobool, default=False, help="Convert the GRU encoder to a static graph to fuse its kernels if True.")
+parser.add_argument("--use_amp", type=distutils.util.strtobool, default=False, help="Enable mixed precision training.")
+parser.add_argument("--scale_loss", type=float, default=2**15, help="The value of scale_loss for fp16.")
 parser.add_argument("--do_eval", type=distutils.util.strtobool, default=True, help="To evaluate the model if True.")
 # yapf: enable
 
 
+@paddle.no_grad()
+def evaluate(model, metric, data_loader):
+    model.eval()
+    metric.reset()
+    # ChunkEvaluator.compute counts the chunks on the host, so sum the counts
+    # there and update the metric once at the end.
+    total_infer_chunks, total_label_chunks, total_correct_chunks = 0, 0, 0
+    for token_ids, length, label_ids in data_loader:
+        _, _, preds = model(token_ids, length)
+        num_infer_chunks, num_label_chunks, num_correct_chunks = metric.compute(
+            None, length, preds, label_ids)
+        total_infer_chunks += num_infer_chunks.numpy()
+        total_label_chunks += num_label_chunks.numpy()
+        total_correct_chunks += num_correct_chunks.numpy()
+    metric.update(total_infer_chunks, total_label_chunks, total_correct_chunks)
+    precision, recall, f1_score = metric.accumulate()
+    print("eval precision: %f - recall: %f - f1: %f" %
+          (precision, recall, f1_score))
+    model.train()
+
+
+@contextlib.contextmanager
+def no_sync(model, enable):
+    """
+    Skip the gradient synchronization of paddle.DataParallel if `enable` is True and it is supported.
+    """
+    if enable and hasattr(model, "no_sync"):
+        with model.no_sync():
+            yield
+    else:
+        yield
+
+
+@contextlib.contextmanager
+def dygraph_emission(network, enable):
+    """
+    Run the encoder of `network` in dygraph mode if `enable` is True, so that the inputs are not bound to the
+    shapes the static encoder is specialized to.
+    """
+    static_emission = network.__dict__.pop("get_emission",
+                                           None) if enable else None
+    try:
+        yield
+    finally:
+        if static_emission is not None:
+            network.get_emission = static_emission
+
+
+def state_dict_to_numpy(state_dict):
+    return {
+        key: value.numpy() if isinstance(value, paddle.Tensor) else value
+        for key, value in state_dict.items()
+    }
+
+
+def save_checkpoint(model_state, optimizer_state, save_prefix):
+    paddle.save(model_state, save_prefix + ".pdparams")
+    paddle.save(optimizer_state, save_prefix + ".pdopt")
+
+
 def train(args):
     paddle.set_device("gpu" if args.n_gpu else "cpu")
+    # Initialize the parallel environment before the expensive dataset
+    # loading, so that all the ranks start the training loop together.
+    world_size = paddle.distributed.get_world_size()
+    rank = paddle.distributed.get_rank()
+    if world_size > 1:
+        paddle.distributed.init_parallel_env()
 
     # Create dataset.
     train_dataset = LacDataset(args.data_dir, mode='train')
     test_dataset = LacDataset(args.data_dir, mode='test')
 
-    batchify_fn = lambda samples, fn=Tuple(
-        Pad(axis=0, pad_val=0),  # word_ids
-        Stack(),  # length
-        Pad(axis=0, pad_val=0),  # label_ids
-    ): fn(samples)
+    # Without bucketing, the static encoder is specialized to batches padded
+    # to max_seq_len.
+    fixed_seq_len = bool(args.to_static and not args.use_bucketing)
+    if fixed_seq_len:
+        num_truncated = int((train_dataset.lengths > args.max_seq_len).sum())
+        if num_truncated:
+            print("warning: %d of %d training sequences are longer than "
+                  "max_seq_len=%d and will be truncated" %
+                  (num_truncated, len(train_dataset), args.max_seq_len))
 
     # Create sampler for dataloader
-    train_sampler = paddle.io.DistributedBatchSampler(
-        dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        drop_last=True)
+    if args.use_bucketing:
+        train_sampler = BucketingBatchSampler(
+            lengths=train_dataset.lengths,
+            batch_size=args.batch_size,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=True,
+            drop_last=True)
+    else:
+        train_sampler = paddle.io.DistributedBatchSampler(
+            dataset=train_dataset,
+            batch_size=args.batch_size,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=True,
+            drop_last=True)
     train_loader = paddle.io.DataLoader(
         dataset=train_dataset,
         batch_sampler=train_sampler,
         return_list=True,
-        collate_fn=batchify_fn)
+        num_workers=args.num_workers,
+        use_shared_memory=True,
+        collate_fn=ReusableBatchify(
+            args.batch_size, args.max_seq_len, fixed_seq_len=fixed_seq_len))
 
     test_sampler = paddle.io.BatchSampler(
         dataset=test_dataset,
@@ -79,39 +171,125 @@ def train(args):
         dataset=test_dataset,
         batch_sampler=test_sampler,
         return_list=True,
-        collate_fn=batchify_fn)
+        num_workers=args.num_workers,
+        use_shared_memory=True,
+        collate_fn=ReusableBatchify(args.batch_size, args.max_seq_len))
 
     # Define the model netword and its loss
     network = BiGruCrf(args.emb_dim, args.hidden_size, train_dataset.vocab_size,
                        train_dataset.num_labels)
+    if args.to_static:
+        # Only the encoder is converted, the crf layers are driven by python
+        # loops over the sequence length.
+        network.get_emission = paddle.jit.to_static(
+            network.get_emission,
+            input_spec=[
+                InputSpec(
+                    shape=[
+                        None, args.max_seq_len if fixed_seq_len else None
+                    ],
+                    dtype='int32',
+                    name='inputs'),
+                InputSpec(
+                    shape=[None], dtype='int64', name='lengths')
+            ])
+    model = paddle.DataParallel(network) if world_size > 1 else network
 
-    inputs = InputSpec(shape=(-1, ), dtype="int16", name='inputs')
-    lengths = InputSpec(shape=(-1, ), dtype="int16", name='lengths')
-    labels = InputSpec(shape=(-1, ), dtype="int16", name='labels')
-    model = paddle.Model(network, inputs=[inputs, lengths, labels])
-
-    # Prepare optimizer, loss and metric evaluator
+    # Prepare optimizer and metric evaluator
     optimizer = paddle.optimizer.Adam(
         learning_rate=args.base_lr, parameters=model.parameters())
-    chunk_evaluator = ChunkEvaluator(
-        label_list=train_dataset.label_vocab.keys(), suffix=True)
-    model.prepare(optimizer, get_loss, chunk_evaluator)
+    label_list = list(train_dataset.label_vocab.keys())
+    chunk_evaluator = ChunkEvaluator(label_list=label_list, suffix=True)
+    if args.use_amp:
+        scaler = paddle.amp.GradScaler(init_loss_scaling=args.scale_loss)
+
     if args.init_checkpoint:
-        model.load(args.init_checkpoint)
+        network.set_state_dict(
+            paddle.load(args.init_checkpoint + ".pdparams"))
+        if os.path.exists(args.init_checkpoint + ".pdopt"):
+            optimizer.set_state_dict(
+                paddle.load(args.init_checkpoint + ".pdopt"))
+
+    if rank == 0 and args.model_save_dir:
+        os.makedirs(args.model_save_dir, exist_ok=True)
+
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
 
     # Start training
-    callbacks = paddle.callbacks.ProgBarLogger(
-        log_freq=10, verbose=3) if args.verbose else None
-    model.fit(train_data=train_loader,
-              eval_data=test_loader if args.do_eval else None,
-              batch_size=args.batch_size,
-              epochs=args.epochs,
-              eval_freq=1,
-              log_freq=10,
-              save_dir=args.model_save_dir,
-              save_freq=1,
-              shuffle=True,
-              callbacks=callbacks)
+    global_step = 0
+    steps_per_epoch = int(math.ceil(len(train_loader) / args.grad_accum_steps))
+    last_step = args.epochs * steps_per_epoch
+    tic_train = time.time()
+    for epoch in range(args.epochs):
+        train_sampler.set_epoch(epoch)
+        for step, batch in enumerate(train_loader):
+            token_ids, length, label_ids = batch
+            is_update_step = (step + 1) % args.grad_accum_steps == 0 or (
+                step + 1) == len(train_loader)
+            # The last window of an epoch may hold fewer micro-batches.
+            window_start = step - step % args.grad_accum_steps
+            window_size = min(args.grad_accum_steps,
+                              len(train_loader) - window_start)
+            # Only all-reduce the gradients at the last micro-batch.
+            with no_sync(model, not is_update_step):
+                # Keep the exponential and logarithm of the CRF in float32.
+                with paddle.amp.auto_cast(
+                        args.use_amp,
+                        custom_black_list=["exp", "log", "logsumexp"]):
+                    loss = model(token_ids, length, label_ids)
+                    avg_loss = paddle.mean(loss)
+                if args.use_amp:
+                    scaled = scaler.scale(avg_loss / window_size)
+                    scaled.backward()
+                else:
+                    (avg_loss / window_size).backward()
+            if not is_update_step:
+                continue
+
+            global_step += 1
+            if global_step % args.logging_steps == 0:
+                # Fetch the loss to the host explicitly and only here, the
+                # rest of the step does not wait for the device.
+                loss_value = float(avg_loss.numpy())
+                print(
+                    "global step %d, epoch: %d, batch: %d, loss: %f, speed: %.2f step/s"
+                    % (global_step, epoch, step, loss_value,
+                       args.logging_steps / (time.time() - tic_train)))
+                tic_train = time.time()
+            if args.use_amp:
+                scaler.minimize(optimizer, scaled)
+            else:
+                optimizer.step()
+            optimizer.clear_grad()
+            if rank != 0:
+                continue
+            if args.do_eval and (global_step % args.eval_steps == 0 or
+                                 global_step == last_step):
+                # The evaluation data is never truncated, so it bypasses the
+                # encoder specialized to max_seq_len.
+                with dygraph_emission(network, fixed_seq_len):
+                    evaluate(network, chunk_evaluator, test_loader)
+            if args.model_save_dir and (global_step % args.save_steps == 0 or
+                                        global_step == last_step):
+                # The final checkpoint keeps the `final` name used by
+                # eval.py and predict.py.
+                save_prefix = os.path.join(
+                    args.model_save_dir, "final"
+                    if global_step == last_step else "model_%d" % global_step)
+                # Only copy the states to host memory here, and leave the
+                # writing to the background thread. Keep at most one save
+                # in flight.
+                if save_future is not None:
+                    save_future.result()
+                save_future = save_executor.submit(
+                    save_checkpoint,
+                    state_dict_to_numpy(network.state_dict()),
+                    state_dict_to_numpy(optimizer.state_dict()), save_prefix)
+
+    if save_future is not None:
+        save_future.result()
+    save_executor.shutdown()
 
 
 if __name__ == "__main__":
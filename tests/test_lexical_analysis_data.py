@@ -0,0 +1,134 @@
+# Copyright (c) 2020 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+    import paddle
+except ImportError:
+    paddle = None
+
+sys.path.insert(0,
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)), "..",
+                    "examples", "lexical_analysis"))
+
+WORDS = ["a", "b", "c", "OOV", "ab"]
+TAGS = ["n-B", "n-I", "O"]
+
+
+@unittest.skipIf(paddle is None, "paddle is not installed")
+class TestLacDataset(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self._write("word.dic", "".join("%s\n" % word for word in WORDS))
+        self._write("tag.dic", "".join("%s\n" % tag for tag in TAGS))
+        self._write("q2b.dic", "Ａ\tA\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.data_dir, name), "w", encoding="utf-8") as f:
+            f.write(content)
+
+    def _load(self, lines):
+        from data import LacDataset
+        self._write("train.tsv", "text_a\tlabel\n" + "\n".join(lines) + "\n")
+        return LacDataset(self.data_dir, mode="train")
+
+    def test_single_characters(self):
+        dataset = self._load(["a\002b\002c\002d\tn-B\002n-I\002O\002O"])
+        word_ids, length, label_ids = dataset[0]
+        self.assertEqual(word_ids.tolist(), [0, 1, 2, 3])
+        self.assertEqual(length, 4)
+        self.assertEqual(label_ids.tolist(), [0, 1, 2, 2])
+
+    def test_empty_and_multi_character_tokens(self):
+        # "" + "ab" has as many characters as there are tokens, but the
+        # tokens are not single characters.
+        dataset = self._load(["\002ab\tO\002n-B"])
+        word_ids, length, label_ids = dataset[0]
+        self.assertEqual(word_ids.tolist(), [3, 4])
+        self.assertEqual(length, 2)
+        self.assertEqual(label_ids.tolist(), [2, 0])
+
+    def test_outdated_cache_is_removed(self):
+        self._load(["a\tn-B"])
+        dataset = self._load(["a\002b\tn-B\002n-I"])
+        cache_dir, cache_name = os.path.split(dataset.cache_path)
+        self.assertEqual(os.listdir(cache_dir), [cache_name])
+
+
+@unittest.skipIf(paddle is None, "paddle is not installed")
+class TestBucketingBatchSampler(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        self.lengths = np.random.RandomState(0).randint(1, 50, size=103)
+
+    def _sampler(self, num_replicas, rank, drop_last=True):
+        from data import BucketingBatchSampler
+        return BucketingBatchSampler(
+            self.lengths,
+            batch_size=4,
+            num_buckets=8,
+            num_replicas=num_replicas,
+            rank=rank,
+            drop_last=drop_last)
+
+    def test_shards_split_the_same_batches(self):
+        batches = list(self._sampler(1, 0))
+        for num_replicas in [1, 2, 3]:
+            samplers = [
+                self._sampler(num_replicas, rank)
+                for rank in range(num_replicas)
+            ]
+            shards = [list(sampler) for sampler in samplers]
+            for sampler, shard in zip(samplers, shards):
+                self.assertEqual(len(shard), len(sampler))
+            num_batches = len(shards[0]) * num_replicas
+            interleaved = [
+                shards[i % num_replicas][i // num_replicas]
+                for i in range(num_batches)
+            ]
+            self.assertEqual(interleaved, batches[:num_batches])
+            indices = [index for batch in interleaved for index in batch]
+            self.assertEqual(len(indices), len(set(indices)))
+
+    def test_padded_shards_cover_all_samples(self):
+        for num_replicas in [1, 2, 3]:
+            indices = set()
+            for rank in range(num_replicas):
+                sampler = self._sampler(num_replicas, rank, drop_last=False)
+                shard = list(sampler)
+                self.assertEqual(len(shard), len(sampler))
+                indices.update(index for batch in shard for index in batch)
+            self.assertEqual(indices, set(range(len(self.lengths))))
+
+    def test_set_epoch_changes_order(self):
+        sampler = self._sampler(1, 0)
+        first = list(sampler)
+        sampler.set_epoch(1)
+        second = list(sampler)
+        self.assertNotEqual(first, second)
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), first)
+
+
+if __name__ == "__main__":
+    unittest.main()